@@ -1,5 +1,5 @@
+import contextlib
 import numpy as np
-import scipy as sp
 from ..utils import record_import_error
 from ._teacher_forcing_logits import TeacherForcingLogits
 
@@ -8,8 +8,32 @@ try:
 except ImportError as e:
     record_import_error("torch", "Torch could not be imported!", e)
 
+def logodds_from_logits(logits, target_sentence_ids):
+    """ Computes the log odds (as one vs all) of the target sentence ids from logits.
+
+    The log odds are the target logit minus the logsumexp of all other logits. Unlike log(p) - log(1-p) this stays
+    finite when the probability of the target token rounds to 1.
+
+    Parameters
+    ----------
+    logits: 3D tensor of shape (batch size, len of target sentence, vocab size)
+        Logits predicting each of the target sentence ids.
+
+    target_sentence_ids: 2D tensor of shape (batch size, len of target sentence)
+        Tokenized ids for which log odds are computed.
+
+    Returns
+    -------
+    tensor
+        Log odds of shape (batch size, len of target sentence).
+    """
+    target_ids = target_sentence_ids.unsqueeze(-1)
+    target_logits = logits.gather(-1, target_ids).squeeze(-1)
+    other_logits = logits.scatter(-1, target_ids, float("-inf"))
+    return target_logits - torch.logsumexp(other_logits, dim=-1)
+
 class PTTeacherForcingLogits(TeacherForcingLogits):
-    def __init__(self, model, tokenizer=None, generation_function_for_target_sentence_ids=None, similarity_model=None, similarity_tokenizer=None, device=None):
+    def __init__(self, model, tokenizer=None, generation_function_for_target_sentence_ids=None, similarity_model=None, similarity_tokenizer=None, device=None, compile_model=False, use_bf16=False):
         """ Generates scores (log odds) for output text explanation algorithms.
 
         This model inherits from TeacherForcingLogits. Check the superclass documentation for the generic methods the library implements for all its model.
@@ -39,12 +63,19 @@ class PTTeacherForcingLogits(TeacherForcingLogits):
         device: "cpu" or "cuda" or None
             By default, it infers if system has a gpu and accordingly sets device. Should be 'cpu' or 'gpu'.
 
+        compile_model: bool
+            If True, the forward pass of a PyTorch similarity model is compiled with torch.compile (requires torch>=2.0).
+
+        use_bf16: bool
+            If True, the forward pass of a PyTorch similarity model runs under bfloat16 autocast on gpus that support it.
+            This is faster but slightly changes the log odds, so it is off by default.
+
         Returns
         -------
         numpy.array
             The scores (log odds) of generating target sentence ids using the model.
         """
-        super(PTTeacherForcingLogits, self).__init__(model, tokenizer, generation_function_for_target_sentence_ids, similarity_model, similarity_tokenizer, device)
+        super(PTTeacherForcingLogits, self).__init__(model, tokenizer, generation_function_for_target_sentence_ids, similarity_model, similarity_tokenizer, device, compile_model, use_bf16)
 
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device
 
@@ -52,6 +83,56 @@ class PTTeacherForcingLogits(TeacherForcingLogits):
             self.similarity_model = similarity_model.to(self.device)
         else:
             self.model = model.to(self.device)
+        # set model to eval mode once, it is only used for inference
+        self.similarity_model.eval()
+
+        # optionally compile the forward pass (torch>=2.0), which mostly cuts kernel launch overhead for the repeated calls
+        self._similarity_forward = self.similarity_model
+        if self.compile_model:
+            if not hasattr(torch, "compile"):
+                raise ValueError("compile_model=True requires torch.compile, which is only available in torch>=2.0")
+            self._similarity_forward = torch.compile(self.similarity_model, mode="reduce-overhead", fullgraph=False)
+
+        # validate the model config and resolve the token ids prepended to the decoder inputs once since the config does not change between calls
+        config = self.similarity_model.config
+        # check if type of model architecture assigned in model config
+        if (hasattr(config, "is_encoder_decoder") and not config.is_encoder_decoder) \
+            and (hasattr(config, "is_decoder") and not config.is_decoder):
+            raise ValueError(
+                "Please assign either of is_encoder_decoder or is_decoder to True in model config for extracting target sentence ids"
+            )
+        self._is_encoder_decoder = bool(getattr(config, "is_encoder_decoder", False))
+        self._decoder_start_token_id = None
+        if self._is_encoder_decoder:
+            # assigning decoder start token id as it is needed for encoder decoder model generation
+            if hasattr(config, "decoder_start_token_id") and config.decoder_start_token_id is not None:
+                self._decoder_start_token_id = config.decoder_start_token_id
+            elif hasattr(config, "bos_token_id") and config.bos_token_id is not None:
+                self._decoder_start_token_id = config.bos_token_id
+            elif (hasattr(config, "decoder") and hasattr(config.decoder, "bos_token_id") and config.decoder.bos_token_id is not None):
+                self._decoder_start_token_id = config.decoder.bos_token_id
+            else:
+                raise ValueError(
+                    "No decoder_start_token_id or bos_token_id defined in config for encoder-decoder generation"
+                )
+        # bos token id is used as context for decoder only models when the source sentence ids are null
+        self._bos_token_id = getattr(config, "bos_token_id", None)
+        self._target_sentence_ids_with_prefix = None
+
+        # inference mode (torch>=1.9) also skips view tracking and version counter bumps on top of disabling gradients
+        self._inference_mode = torch.inference_mode if hasattr(torch, "inference_mode") else torch.no_grad
+        # optionally run the forward passes in bfloat16 on gpus that support it, the log odds are still computed in fp32
+        self._amp_dtype = None
+        if self.use_bf16 and torch.device(self.device).type == "cuda" and hasattr(torch, "autocast") and torch.cuda.is_bf16_supported():
+            self._amp_dtype = torch.bfloat16
+
+    def _autocast(self):
+        """ Returns the mixed precision context for the forward passes of the similarity model.
+        """
+        if self._amp_dtype is None:
+            # contextlib.suppress() with no exceptions is a no-op context that also exists on python 3.6
+            return contextlib.suppress()
+        return torch.autocast("cuda", dtype=self._amp_dtype)
 
     def get_output_names_and_update_target_sentence_ids(self, X):
         """ Gets the output tokens from input(X) by computing the 
@@ -69,9 +150,19 @@ class PTTeacherForcingLogits(TeacherForcingLogits):
             A list of output tokens.
         """
         self.target_sentence_ids = self.generation_function_for_target_sentence_ids(X).to(self.device).to(torch.int64)
-        output_names = [self.similarity_tokenizer.decode([x]).strip() for x in self.target_sentence_ids[0,:].cpu().numpy()]
+        if self._decoder_start_token_id is not None:
+            # the decoder input ids only change with the explanation row, so they are built once here
+            self._target_sentence_ids_with_prefix = self.prepend_decoder_start_token_id(self.target_sentence_ids)
+        # a single transfer to python ints instead of converting each id on its own
+        output_names = [self.similarity_tokenizer.decode([x]).strip() for x in self.target_sentence_ids[0].tolist()]
         return output_names
 
+    def prepend_decoder_start_token_id(self, target_sentence_ids):
+        """ Returns the decoder input ids of an encoder-decoder model by prepending the decoder start token id to the target sentence ids.
+        """
+        target_sentence_start_id = torch.full((target_sentence_ids.shape[0], 1), self._decoder_start_token_id, dtype=target_sentence_ids.dtype, device=target_sentence_ids.device)
+        return torch.cat((target_sentence_start_id,target_sentence_ids),dim=-1)
+
     def get_source_sentence_ids(self, X):
         """ The function tokenizes source sentence.
 
@@ -85,107 +176,146 @@ class PTTeacherForcingLogits(TeacherForcingLogits):
         tensor
             Tensor of source sentence ids.
         """
-        # TODO: batch source_sentence_ids
-        if self.model_agnostic:
-            # In model agnostic case, we first pass the input through the model and then tokenize output sentence
-            source_sentence = self.model(X)
-            source_sentence_ids = torch.tensor([self.similarity_tokenizer.encode(source_sentence)])
-        else:
-            # TODO: check if X is text/image cause presently only when X=text is supported to use model decoder
-            source_sentence_ids = torch.tensor([self.similarity_tokenizer.encode(X)])
+        source_sentence_ids = torch.tensor([list(self.encode_source_sentence(X))])
         source_sentence_ids = source_sentence_ids.to(self.device).to(torch.int64)
         return source_sentence_ids
 
-    def get_logodds(self, logits):
-        """ Calculates log odds from logits.
+    def get_source_sentence_ids_batch(self, masked_X):
+        """ The function tokenizes a batch of source sentences and right pads them to the same length.
+
+        Parameters
+        ----------
+        masked_X: numpy.array
+            An array of masked inputs (text or image).
+
+        Returns
+        -------
+        tuple
+            A tuple of (source sentence ids, attention mask) tensors of shape (batch size, max len of sequence).
+        """
+        encoded_sentences = [self.encode_source_sentence(x) for x in masked_X]
+        max_length = max(len(encoded_sentence) for encoded_sentence in encoded_sentences)
+        if self.compile_model and max_length > 0:
+            # pad to the next power of two so the compiled model only sees a few distinct sequence lengths
+            max_length = 1 << (max_length - 1).bit_length()
+        # padded positions are masked out, so any id can be used when the tokenizer has no pad token (eg: gpt2)
+        pad_token_id = self.similarity_tokenizer.pad_token_id if self.similarity_tokenizer.pad_token_id is not None else 0
+        source_sentence_ids = [list(encoded_sentence) + [pad_token_id] * (max_length - len(encoded_sentence)) for encoded_sentence in encoded_sentences]
+        attention_mask = [[1] * len(encoded_sentence) + [0] * (max_length - len(encoded_sentence)) for encoded_sentence in encoded_sentences]
+        source_sentence_ids = torch.tensor(source_sentence_ids, dtype=torch.int64).reshape(len(encoded_sentences), max_length).to(self.device)
+        attention_mask = torch.tensor(attention_mask, dtype=torch.int64).reshape(len(encoded_sentences), max_length).to(self.device)
+        return source_sentence_ids, attention_mask
 
-        This function passes the logits through softmax and then computes log odds for the target sentence ids.
+    def get_logodds(self, logodds):
+        """ Returns the log odds computed by get_teacher_forced_logits.
+
+        The log odds are already computed on the model device by get_teacher_forced_logits, so they are returned as is.
 
         Parameters
         ----------
-        logits: numpy.array
-            An array of logits generated from the model.
+        logodds: numpy.array
+            An array of log odds of shape (batch size, len of target sentence) generated from the model.
 
         Returns
         -------
         numpy.array
-            Computes log odds for corresponding target sentence ids.
+            Log odds for corresponding target sentence ids, one row per source sentence.
         """
-        logodds = []
-        # pass logits through softmax, get the token corresponding score and convert back to log odds (as one vs all)
-        for i in range(0,logits.shape[1]-1):
-            probs = (np.exp(logits[0][i]).T / np.exp(logits[0][i]).sum(-1)).T
-            logit_dist = sp.special.logit(probs)
-            logodds.append(logit_dist[self.target_sentence_ids[0,i].item()])
-        return np.array(logodds)
+        return logodds
 
-    def get_teacher_forced_logits(self,source_sentence_ids,target_sentence_ids):
-        """ The function generates logits for transformer models.
+    def get_teacher_forced_logits(self,source_sentence_ids,target_sentence_ids,attention_mask=None):
+        """ The function generates log odds of the target sentence ids for transformer models.
 
         It generates logits for encoder-decoder models as well as decoder only models by using the teacher forcing technique.
+        The log odds are computed from the logits on the model device so that only the log odds of the target sentence ids
+        are transferred back.
 
         Parameters
         ----------
         source_sentence_ids: 2D tensor of shape (batch size, len of sequence)
             Tokenized ids fed to the model.
 
-        target_sentence_ids: 2D tensor of shape (batch size, len of sequence)
-            Tokenized ids for which logits are generated using the decoder.
+        target_sentence_ids: 2D tensor of shape (1, len of target sentence)
+            Tokenized ids for which logits are generated using the decoder. The same target sentence ids are teacher forced
+            for every source sentence in the batch.
+
+        attention_mask: 2D tensor of shape (batch size, len of sequence) or None
+            Mask of the non padded positions in the right padded source sentence ids. If None, no position is padded.
 
         Returns
         -------
         numpy.array
-            Decoder output logits for target sentence ids.
+            Log odds of shape (batch size, len of target sentence) for target sentence ids.
         """
-        # set model to eval mode
-        self.similarity_model.eval()
-        # check if type of model architecture assigned in model config
-        if (hasattr(self.similarity_model.config, "is_encoder_decoder") and not self.similarity_model.config.is_encoder_decoder) \
-            and (hasattr(self.similarity_model.config, "is_decoder") and not self.similarity_model.config.is_decoder):
+        if target_sentence_ids.shape[0] != 1:
             raise ValueError(
-                "Please assign either of is_encoder_decoder or is_decoder to True in model config for extracting target sentence ids"
+                "target_sentence_ids must have shape (1, len of target sentence) since they are teacher forced for every source sentence in the batch"
             )
-        if self.similarity_model.config.is_encoder_decoder:
-            # assigning decoder start token id as it is needed for encoder decoder model generation
-            decoder_start_token_id = None
-            if hasattr(self.similarity_model.config, "decoder_start_token_id") and self.similarity_model.config.decoder_start_token_id is not None:
-                decoder_start_token_id = self.similarity_model.config.decoder_start_token_id
-            elif hasattr(self.similarity_model.config, "bos_token_id") and self.similarity_model.config.bos_token_id is not None:
-                decoder_start_token_id = self.similarity_model.config.bos_token_id
-            elif (hasattr(self.similarity_model.config, "decoder") and hasattr(self.similarity_model.config.decoder, "bos_token_id") and self.similarity_model.config.decoder.bos_token_id is not None):
-                decoder_start_token_id = self.similarity_model.config.decoder.bos_token_id
+        if attention_mask is None:
+            attention_mask = torch.ones_like(source_sentence_ids)
+        # different masks often give the same source sentence (eg: fully masked inputs), so each unique row is only scored once
+        if source_sentence_ids.shape[0] > 1:
+            if source_sentence_ids.shape[1] == 0:
+                logodds = self.get_teacher_forced_logits(source_sentence_ids[:1], target_sentence_ids, attention_mask[:1])
+                return np.repeat(logodds, source_sentence_ids.shape[0], axis=0)
+            unique_rows, row_inverse = torch.unique(torch.cat((source_sentence_ids, attention_mask), dim=-1), dim=0, return_inverse=True)
+            if unique_rows.shape[0] < source_sentence_ids.shape[0]:
+                num_source_ids = source_sentence_ids.shape[1]
+                logodds = self.get_teacher_forced_logits(unique_rows[:,:num_source_ids], target_sentence_ids, unique_rows[:,num_source_ids:])
+                return logodds[row_inverse.cpu().numpy()]
+        num_rows = source_sentence_ids.shape[0]
+        if self.compile_model:
+            # pad the batch to the next power of two by repeating the first row, so the compiled model only sees a few distinct
+            # batch sizes, the padded rows are stripped from the log odds below
+            num_padded_rows = (1 << (num_rows - 1).bit_length()) - num_rows
+            if num_padded_rows > 0:
+                source_sentence_ids = torch.cat((source_sentence_ids, source_sentence_ids[:1].expand(num_padded_rows, -1)), dim=0)
+                attention_mask = torch.cat((attention_mask, attention_mask[:1].expand(num_padded_rows, -1)), dim=0)
+        is_explained_row_target = target_sentence_ids is self.target_sentence_ids
+        # the same target sentence ids are teacher forced for every source sentence in the batch
+        target_sentence_ids = target_sentence_ids.to(source_sentence_ids.device).expand(source_sentence_ids.shape[0], -1)
+        if self._is_encoder_decoder:
+            # concat decoder start token id to target sentence ids, which is cached for the target sentence ids of the explained row
+            if is_explained_row_target:
+                decoder_input_ids = self._target_sentence_ids_with_prefix.expand(source_sentence_ids.shape[0], -1)
             else:
-                raise ValueError(
-                    "No decoder_start_token_id or bos_token_id defined in config for encoder-decoder generation"
-                )
-            # concat decoder start token id to target sentence ids
-            target_sentence_start_id = (
-                torch.ones((source_sentence_ids.shape[0], 1), dtype=source_sentence_ids.dtype, device=source_sentence_ids.device)
-                * decoder_start_token_id
-            )
-            target_sentence_ids = torch.cat((target_sentence_start_id,target_sentence_ids),dim=-1)
+                decoder_input_ids = self.prepend_decoder_start_token_id(target_sentence_ids)
             # generate outputs and logits
-            with torch.no_grad():
-                outputs = self.similarity_model(input_ids=source_sentence_ids, decoder_input_ids=target_sentence_ids, labels=target_sentence_ids, return_dict=True)
-            logits=outputs.logits.detach().cpu().numpy().astype('float64')
+            with self._inference_mode(), self._autocast():
+                outputs = self._similarity_forward(input_ids=source_sentence_ids, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids, return_dict=True)
+                # the last position predicts beyond the target sentence
+                logits = outputs.logits[:,:-1,:]
         else:
             # check if source sentence ids are null then add bos token id to decoder
             if source_sentence_ids.shape[1]==0:
-                if hasattr(self.similarity_model.config,"bos_token_id") and self.similarity_model.config.bos_token_id is not None:
-                    source_sentence_ids = (
-                        torch.ones((source_sentence_ids.shape[0], 1), dtype=source_sentence_ids.dtype, device=source_sentence_ids.device)
-                        * self.similarity_model.config.bos_token_id
-                    )
+                source_sentence_ids = source_sentence_ids.new_zeros((source_sentence_ids.shape[0], 1))
+                attention_mask = attention_mask.new_zeros((attention_mask.shape[0], 1))
+            empty_rows = attention_mask[:,0] == 0
+            if empty_rows.any():
+                if self._bos_token_id is not None:
+                    source_sentence_ids = source_sentence_ids.clone()
+                    source_sentence_ids[empty_rows,0] = self._bos_token_id
+                    attention_mask = attention_mask.clone()
+                    attention_mask[empty_rows,0] = 1
                 else:
                     raise ValueError(
                     "Context ids (source sentence ids) are null and no bos token defined in model config"
                 )
             # combine source and target sentence ids  to pass into decoder eg: in case of distillgpt2
+            # the target sentence ids directly follow the source sentence ids of each row and the padding is moved to the end,
+            # so position embeddings are unaffected by padding and causal attention never attends to the padded positions
+            source_lengths = attention_mask.sum(-1, keepdim=True)
+            num_target_ids = target_sentence_ids.shape[1]
+            target_positions = source_lengths + torch.arange(num_target_ids, device=source_lengths.device)
             combined_sentence_ids = torch.cat((source_sentence_ids,target_sentence_ids),dim=-1)
+            combined_sentence_ids = combined_sentence_ids.scatter(1, target_positions, target_sentence_ids)
+            combined_attention_mask = (torch.arange(combined_sentence_ids.shape[1], device=source_lengths.device) < source_lengths + num_target_ids).to(attention_mask.dtype)
             # generate outputs and logits
-            with torch.no_grad():
-                outputs = self.similarity_model(input_ids=combined_sentence_ids, return_dict=True)
-            # extract only logits corresponding to target sentence ids
-            logits=outputs.logits.detach().cpu().numpy()[:,source_sentence_ids.shape[1]-1:,:].astype('float64')
-        del outputs
-        return logits
\ No newline at end of file
+            with self._inference_mode(), self._autocast():
+                outputs = self._similarity_forward(input_ids=combined_sentence_ids, attention_mask=combined_attention_mask, return_dict=True)
+                # extract only logits corresponding to target sentence ids, the logits at position i predict token i+1
+                logits_positions = (target_positions - 1).unsqueeze(-1).expand(-1, -1, outputs.logits.shape[-1])
+                logits = outputs.logits.gather(1, logits_positions)
+        # compute the log odds in fp32 on the model device and only keep the scores of the target sentence ids
+        logodds = logodds_from_logits(logits.float(), target_sentence_ids)[:num_rows]
+        return logodds.cpu().numpy()
\ No newline at end of file
@@ -1,11 +1,36 @@
+import functools
 import numpy as np
 import scipy as sp
 from ._model import Model
 from ..utils import safe_isinstance, record_import_error
 from .. import models
 
+# maps the class path of a transformers model to the names of its backend (teacher forcing logits, text generation) classes,
+# names are used since the backend modules import this module
+_BACKEND_REGISTRY = {
+    "transformers.PreTrainedModel": ("PTTeacherForcingLogits", "PTTextGeneration"),
+    "transformers.TFPreTrainedModel": ("TFTeacherForcingLogits", "TFTextGeneration"),
+}
+
+def _resolve_backend(model):
+    """ Returns the backend (teacher forcing logits, text generation) classes of a transformers model or None otherwise.
+    """
+    for class_path, (teacher_forcing_logits_name, text_generation_name) in _BACKEND_REGISTRY.items():
+        if safe_isinstance(model, class_path):
+            return getattr(models, teacher_forcing_logits_name), getattr(models, text_generation_name)
+    return None
+
+def _is_same_X(X, other):
+    """ Returns True if two original inputs (text or image) belong to the same explanation row.
+    """
+    if X is other:
+        return True
+    if isinstance(X, np.ndarray) or isinstance(other, np.ndarray):
+        return isinstance(X, np.ndarray) and isinstance(other, np.ndarray) and np.array_equal(X, other)
+    return X == other
+
 class TeacherForcingLogits(Model):
-    def __init__(self, model, tokenizer=None, generation_function_for_target_sentence_ids=None, similarity_model=None, similarity_tokenizer=None, device=None):
+    def __init__(self, model, tokenizer=None, generation_function_for_target_sentence_ids=None, similarity_model=None, similarity_tokenizer=None, device=None, compile_model=False, use_bf16=False):
         """ Generates scores (log odds) for output text explanation algorithms.
 
         This class supports generation of log odds for transformer models as well as functions. It also provides 
@@ -33,62 +58,63 @@ class TeacherForcingLogits(Model):
         device: "cpu" or "cuda" or None
             By default, it infers if system has a gpu and accordingly sets device. Should be 'cpu' or 'gpu'.
 
+        compile_model: bool
+            If True, the forward pass of a PyTorch similarity model is compiled with torch.compile (requires torch>=2.0).
+
+        use_bf16: bool
+            If True, the forward pass of a PyTorch similarity model runs under bfloat16 autocast on gpus that support it.
+            This is faster but slightly changes the log odds, so it is off by default.
+
         Returns
         -------
         numpy.array
             The scores (log odds) of generating target sentence ids using the model.
         """
+        if self.__class__ is TeacherForcingLogits:
+            # assign the right subclass, its constructor runs this constructor once through super()
+            self._backend = _resolve_backend(model) or _resolve_backend(similarity_model)
+            if self._backend is None:
+                raise Exception("Cannot determine subclass to be assigned in TeacherForcingLogits. Please define similarity model or model of instance transformers.PreTrainedModel or transformers.TFPreTrainedModel.")
+            self.__class__ = self._backend[0]
+            self.__class__.__init__(self, model, tokenizer, generation_function_for_target_sentence_ids, similarity_model, similarity_tokenizer, device, compile_model, use_bf16)
+            return
+
         super(TeacherForcingLogits, self).__init__(model)
 
         #self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device 
         self.tokenizer = tokenizer
         self.device = device
-        # assign text generation function
-        if safe_isinstance(model,"transformers.PreTrainedModel") or safe_isinstance(model,"transformers.TFPreTrainedModel"):
-            if generation_function_for_target_sentence_ids is None:
-                if safe_isinstance(model,"transformers.PreTrainedModel"):
-                    self.generation_function_for_target_sentence_ids = models.PTTextGeneration(self.model, tokenizer=self.tokenizer, device=self.device)
-                elif safe_isinstance(model,"transformers.TFPreTrainedModel"):
-                    self.generation_function_for_target_sentence_ids = models.TFTextGeneration(self.model, tokenizer=self.tokenizer, device=self.device)
-                else:
-                    raise Exception("Cannot determine generation_function_for_target_sentence_ids to be assigned in TeacherForcingLogits. Please define model of instance transformers.PreTrainedModel or transformers.TFPreTrainedModel.")
-            else:
-                self.generation_function_for_target_sentence_ids = generation_function_for_target_sentence_ids
-            self.model_agnostic = False
+        self.compile_model = compile_model
+        self.use_bf16 = use_bf16
+        # the backend is already resolved when we were converted from TeacherForcingLogits
+        if getattr(self, "_backend", None) is None:
+            self._backend = _resolve_backend(model) or _resolve_backend(similarity_model)
+        self.model_agnostic = not safe_isinstance(model, list(_BACKEND_REGISTRY))
+        if self.model_agnostic:
+            self.similarity_model = similarity_model
+            self.similarity_tokenizer = similarity_tokenizer
+        else:
             #self.model = self.to_device(model)
             self.similarity_model = model
             self.similarity_tokenizer = tokenizer
-        else:
-            if generation_function_for_target_sentence_ids is None:
-                if safe_isinstance(similarity_model,"transformers.PreTrainedModel"):
-                    self.generation_function_for_target_sentence_ids = models.PTTextGeneration(self.model, similarity_tokenizer=similarity_tokenizer, device=self.device)
-                elif safe_isinstance(similarity_model,"transformers.TFPreTrainedModel"):
-                    self.generation_function_for_target_sentence_ids = models.TFTextGeneration(self.model, similarity_tokenizer=similarity_tokenizer, device=self.device)
-                else:
-                    raise Exception("Cannot determine generation_function_for_target_sentence_ids to be assigned in TeacherForcingLogits. Please define similarity_model of instance transformers.PreTrainedModel or transformers.TFPreTrainedModel.")
+        # assign text generation function
+        if generation_function_for_target_sentence_ids is None:
+            if self._backend is None:
+                raise Exception("Cannot determine generation_function_for_target_sentence_ids to be assigned in TeacherForcingLogits. Please define similarity_model of instance transformers.PreTrainedModel or transformers.TFPreTrainedModel.")
+            text_generation = self._backend[1]
+            if self.model_agnostic:
+                self.generation_function_for_target_sentence_ids = text_generation(self.model, similarity_tokenizer=similarity_tokenizer, device=self.device)
             else:
-                self.generation_function_for_target_sentence_ids = generation_function_for_target_sentence_ids
-            #self.similarity_model = self.to_device(similarity_model)
-            self.similarity_model = similarity_model
-            self.similarity_tokenizer = similarity_tokenizer
-            self.model_agnostic = True
+                self.generation_function_for_target_sentence_ids = text_generation(self.model, tokenizer=self.tokenizer, device=self.device)
+        else:
+            self.generation_function_for_target_sentence_ids = generation_function_for_target_sentence_ids
+        # the same masked texts are scored many times while sampling, so their tokenization is cached by the raw text
+        self._encode_source_text = functools.lru_cache(maxsize=4096)(lambda text: tuple(self.similarity_tokenizer.encode(text)))
         # initializing X which is the original input for every new row of explanation
         self.X = None
         self.target_sentence_ids = None
         self.output_names = None
 
-        if self.__class__ is TeacherForcingLogits:
-            # assign the right subclass
-            if safe_isinstance(self.similarity_model,"transformers.PreTrainedModel"):
-                self.__class__ = models.PTTeacherForcingLogits
-                models.PTTeacherForcingLogits.__init__(self, self.model, self.tokenizer, self.generation_function_for_target_sentence_ids, self.similarity_model, self.similarity_tokenizer, self.device)
-            elif safe_isinstance(self.similarity_model,"transformers.TFPreTrainedModel"):
-                self.__class__ = models.TFTeacherForcingLogits
-                models.TFTeacherForcingLogits.__init__(self, self.model, self.tokenizer, self.generation_function_for_target_sentence_ids, self.similarity_model, self.similarity_tokenizer, self.device)
-            else:
-                raise Exception("Cannot determine subclass to be assigned in TeacherForcingLogits. Please define similarity model or model of instance transformers.PreTrainedModel or transformers.TFPreTrainedModel.")
-
-
     def __call__(self, masked_X, X):
         """ Computes log odds scores from a given batch of masked input and original input for text/image.
 
@@ -105,16 +131,31 @@ class TeacherForcingLogits(Model):
         numpy.array
             A numpy array of log odds scores for every input pair (masked_X, X)
         """
-        output_batch=[]
-        for masked_x, x in zip(masked_X, X):
+        output_batch = None
+        start = 0
+        while start < len(masked_X):
+            # consecutive masked inputs of the same explanation row share the target sentence ids, so we score them in one batch
+            end = start + 1
+            while end < len(masked_X) and _is_same_X(X[end], X[start]):
+                end += 1
             # update target sentence ids and original input for a new explanation row
-            self.update_cache_X(x)
-            # pass the masked input from which to generate source sentence ids
-            source_sentence_ids = self.get_source_sentence_ids(masked_x)
-            logits = self.get_teacher_forced_logits(source_sentence_ids, self.target_sentence_ids)
+            self.update_cache_X(X[start])
+            # pass the masked inputs from which to generate padded source sentence ids
+            source_sentence_ids, attention_mask = self.get_source_sentence_ids_batch(masked_X[start:end])
+            logits = self.get_teacher_forced_logits(source_sentence_ids, self.target_sentence_ids, attention_mask)
             logodds = self.get_logodds(logits)
-            output_batch.append(logodds)
-        return np.array(output_batch)
+            # the first batch tells us the target sentence length, so the output is allocated once
+            if output_batch is None:
+                output_batch = np.empty((len(masked_X), logodds.shape[1]), dtype=logodds.dtype)
+            elif logodds.shape[1] != output_batch.shape[1]:
+                raise ValueError(
+                    "All inputs in a call to TeacherForcingLogits must have target sentences of the same length, got %d and %d" % (output_batch.shape[1], logodds.shape[1])
+                )
+            output_batch[start:end] = logodds
+            start = end
+        if output_batch is None:
+            return np.array([])
+        return output_batch
 
     def update_cache_X(self, X):
         """ The function updates original input(X) and target sentence ids.
@@ -128,7 +169,7 @@ class TeacherForcingLogits(Model):
             Input(Text/Image) for an explanation row.
         """
         # check if the source sentence has been updated (occurs when explaining a new row)
-        if (self.X is None) or (isinstance(self.X, np.ndarray) and (self.X != X).all()) or (isinstance(self.X, str) and (self.X != X)):
+        if (self.X is None) or not _is_same_X(self.X, X):
             self.X = X
             self.output_names = self.get_output_names_and_update_target_sentence_ids(self.X)
     
@@ -150,17 +191,39 @@ class TeacherForcingLogits(Model):
         self.target_sentence_ids = self.generation_function_for_target_sentence_ids(X)
         return self.similarity_tokenizer.convert_ids_to_tokens(self.target_sentence_ids[0,:])
 
+    def encode_source_sentence(self, X):
+        """ Returns a tuple of token ids for the source sentence of the (masked) input X.
+        """
+        # TODO: check if X is text/image cause presently only when X=text is supported to use model decoder
+        if self.model_agnostic:
+            # In model agnostic case, we first pass the input through the model and then tokenize output sentence
+            X = self.model(X)
+        if isinstance(X, str):
+            return self._encode_source_text(X)
+        return tuple(self.similarity_tokenizer.encode(X))
+
     def get_source_sentence_ids(self, X):
         """ Implement in subclass. Returns a tensor of sentence ids.
         """
         pass
 
+    def get_source_sentence_ids_batch(self, masked_X):
+        """ Implement in subclass. Returns a tuple of padded source sentence ids and their attention mask.
+        """
+        pass
+
     def get_logodds(self, logits):
-        """ Implement in subclass. Returns a np.array of logodds.
+        """ Implement in subclass. Returns a np.array of logodds of shape (batch size, len of target sentence).
+
+        The input is the output of get_teacher_forced_logits. The PyTorch backend already returns log odds there, so it
+        returns them as is, while the TensorFlow backend converts its logits to log odds here.
         """
         pass
 
-    def get_teacher_forced_logits(self,source_sentence_ids,target_sentence_ids):
-        """ Implement in subclass. Returns a np.array of logits.
+    def get_teacher_forced_logits(self,source_sentence_ids,target_sentence_ids,attention_mask=None):
+        """ Implement in subclass. Returns a np.array that get_logodds turns into log odds.
+
+        The PyTorch backend returns the log odds of shape (batch size, len of target sentence) computed on the model
+        device, the TensorFlow backend returns logits of shape (batch size, len of target sentence + 1, vocab size).
         """
         pass
\ No newline at end of file
@@ -1,5 +1,4 @@
 import numpy as np
-import scipy as sp
 from ..utils import record_import_error
 from ._teacher_forcing_logits import TeacherForcingLogits
 
@@ -9,7 +8,7 @@ except ImportError as e:
     record_import_error("tensorflow", "TensorFlow could not be imported!", e)
 
 class TFTeacherForcingLogits(TeacherForcingLogits):
-    def __init__(self, model, tokenizer=None, generation_function_for_target_sentence_ids=None, similarity_model=None, similarity_tokenizer=None, device=None):
+    def __init__(self, model, tokenizer=None, generation_function_for_target_sentence_ids=None, similarity_model=None, similarity_tokenizer=None, device=None, compile_model=False, use_bf16=False):
         """ Generates scores (log odds) for output text explanation algorithms.
 
         This class supports generation of log odds for transformer models as well as functions. It also provides 
@@ -37,12 +36,18 @@ class TFTeacherForcingLogits(TeacherForcingLogits):
         device: "cpu" or "cuda" or None
             By default, it infers if system has a gpu and accordingly sets device. Should be 'cpu' or 'gpu'.
 
+        compile_model: bool
+            Only supported for PyTorch models, ignored for TensorFlow models.
+
+        use_bf16: bool
+            Only supported for PyTorch models, ignored for TensorFlow models.
+
         Returns
         -------
         numpy.array
             The scores (log odds) of generating target sentence ids using the model.
         """
-        super(TFTeacherForcingLogits, self).__init__(model, tokenizer, generation_function_for_target_sentence_ids, similarity_model, similarity_tokenizer, device)
+        super(TFTeacherForcingLogits, self).__init__(model, tokenizer, generation_function_for_target_sentence_ids, similarity_model, similarity_tokenizer, device, compile_model, use_bf16)
 
     def get_source_sentence_ids(self, X):
         """ The function tokenizes source sentence.
@@ -57,20 +62,37 @@ class TFTeacherForcingLogits(TeacherForcingLogits):
         tf.Tensor
             Tensor of source sentence ids.
         """
-        # TODO: batch source_sentence_ids
-        if self.model_agnostic:
-            # In model agnostic case, we first pass the input through the model and then tokenize output sentence
-            source_sentence = self.model(X)
-            source_sentence_ids = tf.convert_to_tensor([self.similarity_tokenizer.encode(source_sentence)])
-        else:
-            # TODO: check if X is text/image cause presently only when X=text is supported to use model decoder
-            source_sentence_ids = tf.convert_to_tensor([self.similarity_tokenizer.encode(X)])
+        source_sentence_ids = tf.convert_to_tensor([list(self.encode_source_sentence(X))])
         return source_sentence_ids
 
+    def get_source_sentence_ids_batch(self, masked_X):
+        """ The function tokenizes a batch of source sentences and right pads them to the same length.
+
+        Parameters
+        ----------
+        masked_X: numpy.array
+            An array of masked inputs (text or image).
+
+        Returns
+        -------
+        tuple
+            A tuple of (source sentence ids, attention mask) tf.Tensors of shape (batch size, max len of sequence).
+        """
+        encoded_sentences = [self.encode_source_sentence(x) for x in masked_X]
+        max_length = max(len(encoded_sentence) for encoded_sentence in encoded_sentences)
+        # padded positions are masked out, so any id can be used when the tokenizer has no pad token (eg: gpt2)
+        pad_token_id = self.similarity_tokenizer.pad_token_id if self.similarity_tokenizer.pad_token_id is not None else 0
+        source_sentence_ids = np.full((len(encoded_sentences), max_length), pad_token_id, dtype=np.int32)
+        attention_mask = np.zeros((len(encoded_sentences), max_length), dtype=np.int32)
+        for i, encoded_sentence in enumerate(encoded_sentences):
+            source_sentence_ids[i,:len(encoded_sentence)] = encoded_sentence
+            attention_mask[i,:len(encoded_sentence)] = 1
+        return tf.convert_to_tensor(source_sentence_ids), tf.convert_to_tensor(attention_mask)
+
     def get_logodds(self, logits):
         """ Calculates log odds from logits.
 
-        This function passes the logits through softmax and then computes log odds for the target sentence ids.
+        This function computes log odds (as one vs all) for the target sentence ids directly from the logits.
 
         Parameters
         ----------
@@ -80,17 +102,22 @@ class TFTeacherForcingLogits(TeacherForcingLogits):
         Returns
         -------
         numpy.array
-            Computes log odds for corresponding target sentence ids.
+            Computes log odds for corresponding target sentence ids, one row per source sentence.
         """
-        logodds = []
-        # pass logits through softmax, get the token corresponding score and convert back to log odds (as one vs all)
-        for i in range(0,logits.shape[1]-1):
-            probs = (np.exp(logits[0][i]).T / np.exp(logits[0][i]).sum(-1)).T
-            logit_dist = sp.special.logit(probs)
-            logodds.append(logit_dist[self.target_sentence_ids[0,i].numpy()])
-        return np.array(logodds)
-
-    def get_teacher_forced_logits(self,source_sentence_ids,target_sentence_ids):
+        # the last position predicts beyond the target sentence, so only the first T-1 positions are scored
+        num_target_ids = logits.shape[1] - 1
+        target_ids = self.target_sentence_ids.numpy()[0, :num_target_ids]
+        positions = np.arange(num_target_ids)
+        target_logits = logits[:, positions, target_ids]
+        # log odds (as one vs all) are the target logit minus the logsumexp of all other logits, unlike log(p) - log(1-p)
+        # this stays finite in fp32 when the probability of the target token rounds to 1
+        other_logits = logits[:, :-1, :].copy()
+        other_logits[:, positions, target_ids] = -np.inf
+        max_other_logits = other_logits.max(-1)
+        log_norm = max_other_logits + np.log(np.exp(other_logits - max_other_logits[..., None]).sum(-1))
+        return target_logits - log_norm
+
+    def get_teacher_forced_logits(self,source_sentence_ids,target_sentence_ids,attention_mask=None):
         """ The function generates logits for transformer models.
 
         It generates logits for encoder-decoder models as well as decoder only models by using the teacher forcing technique.
@@ -100,8 +127,12 @@ class TFTeacherForcingLogits(TeacherForcingLogits):
         source_sentence_ids: tf.Tensor of shape (batch size, len of sequence)
             Tokenized ids fed to the model.
 
-        target_sentence_ids: tf.Tensor of shape (batch size, len of sequence)
-            Tokenized ids for which logits are generated using the decoder.
+        target_sentence_ids: tf.Tensor of shape (1, len of target sentence)
+            Tokenized ids for which logits are generated using the decoder. The same target sentence ids are teacher forced
+            for every source sentence in the batch.
+
+        attention_mask: tf.Tensor of shape (batch size, len of sequence) or None
+            Mask of the non padded positions in the right padded source sentence ids. If None, no position is padded.
 
         Returns
         -------
@@ -114,6 +145,14 @@ class TFTeacherForcingLogits(TeacherForcingLogits):
             raise ValueError(
                 "Please assign either of is_encoder_decoder or is_decoder to True in model config for extracting target sentence ids"
             )
+        if target_sentence_ids.shape[0] != 1:
+            raise ValueError(
+                "target_sentence_ids must have shape (1, len of target sentence) since they are teacher forced for every source sentence in the batch"
+            )
+        if attention_mask is None:
+            attention_mask = tf.ones_like(source_sentence_ids)
+        # the same target sentence ids are teacher forced for every source sentence in the batch
+        target_sentence_ids = tf.tile(target_sentence_ids, (source_sentence_ids.shape[0], 1))
         if self.similarity_model.config.is_encoder_decoder:
             # assigning decoder start token id as it is needed for encoder decoder model generation
             decoder_start_token_id = None
@@ -135,38 +174,53 @@ class TFTeacherForcingLogits(TeacherForcingLogits):
             target_sentence_ids = tf.concat((target_sentence_start_id,target_sentence_ids), axis=-1)
             # generate outputs and logits
             if self.device is None:
-                outputs = self.similarity_model(source_sentence_ids, decoder_input_ids=target_sentence_ids, labels=target_sentence_ids, return_dict=True)
+                outputs = self.similarity_model(source_sentence_ids, attention_mask=attention_mask, decoder_input_ids=target_sentence_ids, return_dict=True)
             else:
                 try:
                     with tf.device(self.device):
-                        outputs = self.similarity_model(source_sentence_ids, decoder_input_ids=target_sentence_ids, labels=target_sentence_ids, return_dict=True)
+                        outputs = self.similarity_model(source_sentence_ids, attention_mask=attention_mask, decoder_input_ids=target_sentence_ids, return_dict=True)
                 except RuntimeError as e:
                     print(e)
-            logits=outputs.logits.numpy().astype('float64')
+            logits=tf.cast(outputs.logits, tf.float32).numpy()
         else:
+            source_sentence_ids = source_sentence_ids.numpy()
+            attention_mask = attention_mask.numpy()
+            target_sentence_ids = target_sentence_ids.numpy()
             # check if source sentence ids are null then add bos token id to decoder
             if source_sentence_ids.shape[1]==0:
+                source_sentence_ids = np.zeros((source_sentence_ids.shape[0], 1), dtype=source_sentence_ids.dtype)
+                attention_mask = np.zeros((attention_mask.shape[0], 1), dtype=attention_mask.dtype)
+            empty_rows = attention_mask[:,0] == 0
+            if empty_rows.any():
                 if hasattr(self.similarity_model.config,"bos_token_id") and self.similarity_model.config.bos_token_id is not None:
-                    source_sentence_ids = (
-                        tf.ones((source_sentence_ids.shape[0], 1), dtype=tf.int32)
-                        * self.similarity_model.config.bos_token_id
-                    )
+                    source_sentence_ids = source_sentence_ids.copy()
+                    source_sentence_ids[empty_rows,0] = self.similarity_model.config.bos_token_id
+                    attention_mask = attention_mask.copy()
+                    attention_mask[empty_rows,0] = 1
                 else:
                     raise ValueError(
                     "Context ids (source sentence ids) are null and no bos token defined in model config"
                 )
             # combine source and target sentence ids  to pass into decoder eg: in case of distillgpt2
-            combined_sentence_ids = tf.concat((source_sentence_ids,target_sentence_ids),axis=-1)
+            # the target sentence ids directly follow the source sentence ids of each row and the padding is moved to the end,
+            # so position embeddings are unaffected by padding and causal attention never attends to the padded positions
+            source_lengths = attention_mask.sum(-1, keepdims=True)
+            num_target_ids = target_sentence_ids.shape[1]
+            rows = np.arange(source_sentence_ids.shape[0])[:,None]
+            combined_sentence_ids = np.concatenate((source_sentence_ids,target_sentence_ids),axis=-1)
+            combined_sentence_ids[rows, source_lengths + np.arange(num_target_ids)] = target_sentence_ids
+            combined_attention_mask = (np.arange(combined_sentence_ids.shape[1]) < source_lengths + num_target_ids).astype(attention_mask.dtype)
+            combined_sentence_ids = tf.convert_to_tensor(combined_sentence_ids)
+            combined_attention_mask = tf.convert_to_tensor(combined_attention_mask)
             # generate outputs and logits
             if self.device is None:
-                outputs = self.similarity_model(combined_sentence_ids, return_dict=True)
+                outputs = self.similarity_model(combined_sentence_ids, attention_mask=combined_attention_mask, return_dict=True)
             else:
                 try:
                     with tf.device(self.device):
-                        outputs = self.similarity_model(combined_sentence_ids, return_dict=True)
+                        outputs = self.similarity_model(combined_sentence_ids, attention_mask=combined_attention_mask, return_dict=True)
                 except RuntimeError as e:
                     print(e)
-            # extract only logits corresponding to target sentence ids
-            logits=outputs.logits.numpy()[:,source_sentence_ids.shape[1]-1:,:].astype('float64')
-        del outputs
+            # extract only logits corresponding to target sentence ids, the logits at position i predict token i+1
+            logits=tf.cast(outputs.logits, tf.float32).numpy()[rows, source_lengths - 1 + np.arange(num_target_ids + 1), :]
         return logits
\ No newline at end of file
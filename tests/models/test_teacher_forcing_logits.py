@@ -67,3 +67,204 @@ def test_method_get_teacher_forced_logits_for_decoder_model():
     logits = wrapped_model.get_teacher_forced_logits(source_sentence_ids, target_sentence_ids)
 
     assert not np.isnan(np.sum(logits))
+
+def test_call_batches_masked_inputs_of_different_lengths():
+    """ Tests if scoring masked inputs of different lengths in one batch matches scoring them one at a time.
+    """
+
+    pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained("gpt2")
+    model = transformers.AutoModelForCausalLM.from_pretrained("gpt2")
+    model.config.is_decoder = True
+
+    wrapped_model = shap.models.TeacherForcingLogits(model, tokenizer, device='cpu')
+
+    X = np.array(["This is a test statement for verifying"] * 3)
+    masked_X = np.array(["This is a test statement for verifying", "This is a ...", ""])
+
+    batched_logodds = wrapped_model(masked_X, X)
+    single_logodds = np.concatenate([wrapped_model(masked_X[i:i+1], X[i:i+1]) for i in range(len(masked_X))])
+
+    assert batched_logodds.shape == single_logodds.shape
+    assert np.allclose(batched_logodds, single_logodds, atol=1e-4)
+
+def test_logodds_from_logits_stays_finite_for_confident_logits():
+    """ Tests if the log odds stay finite when the probability of the target token rounds to 1 in fp32.
+    """
+
+    torch = pytest.importorskip("torch")
+    from shap.models._pt_teacher_forcing_logits import logodds_from_logits
+
+    logits = torch.zeros((1, 2, 5), dtype=torch.float32)
+    logits[0, 0, 1] = 40.0
+    logits[0, 1, 3] = -40.0
+    target_sentence_ids = torch.tensor([[1, 3]])
+
+    logodds = logodds_from_logits(logits, target_sentence_ids).numpy()
+
+    assert np.all(np.isfinite(logodds))
+    assert np.allclose(logodds, [[40 - np.log(4), -40 - np.log(4)]], atol=1e-5)
+
+def test_call_batches_ndarray_inputs_of_the_same_row():
+    """ Tests if masked inputs whose original inputs are equal numpy arrays (but different objects) are scored in one batch.
+    """
+
+    pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained("gpt2")
+    model = transformers.AutoModelForCausalLM.from_pretrained("gpt2")
+    model.config.is_decoder = True
+
+    def f(x):
+        return " ".join(x)
+
+    wrapped_model = shap.models.TeacherForcingLogits(f, similarity_model=model, similarity_tokenizer=tokenizer, device='cpu')
+
+    X = np.array([["This", "is", "a", "test"]] * 3)
+    masked_X = np.array([["This", "is", "a", "test"], ["This", "...", "a", "test"], ["...", "...", "...", "test"]])
+
+    batch_sizes = []
+    get_source_sentence_ids_batch = wrapped_model.get_source_sentence_ids_batch
+    def record_batch_size(masked_inputs):
+        batch_sizes.append(len(masked_inputs))
+        return get_source_sentence_ids_batch(masked_inputs)
+    wrapped_model.get_source_sentence_ids_batch = record_batch_size
+
+    batched_logodds = wrapped_model(masked_X, X)
+    assert batch_sizes == [len(masked_X)]
+
+    single_logodds = np.concatenate([wrapped_model(masked_X[i:i+1], X[i:i+1]) for i in range(len(masked_X))])
+    assert np.allclose(batched_logodds, single_logodds, atol=1e-4)
+
+def test_update_cache_X_regenerates_target_for_partially_different_ndarray_rows():
+    """ Tests if the target sentence ids are regenerated for a new ndarray row that shares some elements with the cached row.
+    """
+
+    pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained("gpt2")
+    model = transformers.AutoModelForCausalLM.from_pretrained("gpt2")
+    model.config.is_decoder = True
+
+    def f(x):
+        return " ".join(x)
+
+    wrapped_model = shap.models.TeacherForcingLogits(f, similarity_model=model, similarity_tokenizer=tokenizer, device='cpu')
+
+    wrapped_model.update_cache_X(np.array(["This", "is", "a", "test"]))
+    first_output_names = wrapped_model.output_names
+
+    wrapped_model.update_cache_X(np.array(["This", "is", "another", "test"]))
+
+    assert first_output_names != wrapped_model.output_names
+    assert "another" in wrapped_model.output_names
+
+@pytest.mark.parametrize("masked_X", [
+    ["This is a ...", "This is a ...", "... test statement for verifying", "This is a ..."],
+    ["", "", ""],
+])
+def test_call_scores_duplicate_and_empty_masked_inputs_like_single_inputs(masked_X):
+    """ Tests if deduplicated (duplicate or all empty) masked inputs are scored the same as scoring them one at a time.
+    """
+
+    pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained("gpt2")
+    model = transformers.AutoModelForCausalLM.from_pretrained("gpt2")
+    model.config.is_decoder = True
+
+    wrapped_model = shap.models.TeacherForcingLogits(model, tokenizer, device='cpu')
+
+    masked_X = np.array(masked_X)
+    X = np.array(["This is a test statement for verifying"] * len(masked_X))
+
+    batched_logodds = wrapped_model(masked_X, X)
+    single_logodds = np.concatenate([wrapped_model(masked_X[i:i+1], X[i:i+1]) for i in range(len(masked_X))])
+
+    assert batched_logodds.shape == single_logodds.shape
+    assert np.allclose(batched_logodds, single_logodds, atol=1e-4)
+
+def test_call_batches_masked_inputs_for_encoder_decoder_model():
+    """ Tests if scoring right padded masked inputs in one batch matches scoring them one at a time for encoder-decoder models.
+    """
+
+    pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained("sshleifer/distilbart-xsum-12-6")
+    model = transformers.AutoModelForSeq2SeqLM.from_pretrained("sshleifer/distilbart-xsum-12-6")
+
+    wrapped_model = shap.models.TeacherForcingLogits(model, tokenizer, device='cpu')
+
+    source_sentence = "This is a test statement for verifying working of teacher forcing logits functionality"
+    X = np.array([source_sentence] * 3)
+    masked_X = np.array([source_sentence, "This is a ... for verifying ...", "..."])
+
+    batched_logodds = wrapped_model(masked_X, X)
+    single_logodds = np.concatenate([wrapped_model(masked_X[i:i+1], X[i:i+1]) for i in range(len(masked_X))])
+
+    assert batched_logodds.shape == single_logodds.shape
+    assert np.allclose(batched_logodds, single_logodds, atol=1e-4)
+
+def test_call_batches_masked_inputs_for_tf_decoder_model():
+    """ Tests if scoring masked inputs of different lengths in one batch matches scoring them one at a time for TensorFlow models.
+    """
+
+    pytest.importorskip("tensorflow")
+    transformers = pytest.importorskip("transformers")
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained("gpt2")
+    model = transformers.TFAutoModelForCausalLM.from_pretrained("gpt2")
+    model.config.is_decoder = True
+
+    wrapped_model = shap.models.TeacherForcingLogits(model, tokenizer)
+
+    X = np.array(["This is a test statement for verifying"] * 3)
+    masked_X = np.array(["This is a test statement for verifying", "This is a ...", ""])
+
+    batched_logodds = wrapped_model(masked_X, X)
+    single_logodds = np.concatenate([wrapped_model(masked_X[i:i+1], X[i:i+1]) for i in range(len(masked_X))])
+
+    assert batched_logodds.shape == single_logodds.shape
+    assert np.allclose(batched_logodds, single_logodds, atol=1e-4)
+
+def test_call_reuses_cached_decoder_input_ids_for_encoder_decoder_model():
+    """ Tests if __call__ reuses the decoder input ids cached for the explained row and scores the same as an external target.
+    """
+
+    pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained("sshleifer/distilbart-xsum-12-6")
+    model = transformers.AutoModelForSeq2SeqLM.from_pretrained("sshleifer/distilbart-xsum-12-6")
+
+    wrapped_model = shap.models.TeacherForcingLogits(model, tokenizer, device='cpu')
+
+    prepend_calls = []
+    prepend_decoder_start_token_id = wrapped_model.prepend_decoder_start_token_id
+    def record_prepend(target_sentence_ids):
+        prepend_calls.append(target_sentence_ids)
+        return prepend_decoder_start_token_id(target_sentence_ids)
+    wrapped_model.prepend_decoder_start_token_id = record_prepend
+
+    source_sentence = "This is a test statement for verifying working of teacher forcing logits functionality"
+    X = np.array([source_sentence] * 2)
+    masked_X = np.array([source_sentence, "This is a ... for verifying ..."])
+
+    logodds = wrapped_model(masked_X, X)
+    wrapped_model(masked_X[::-1], X)
+
+    # the prefix is only built once, when the target sentence ids of the row are generated
+    assert len(prepend_calls) == 1
+
+    # scoring a copy of the target sentence ids takes the uncached path and must give the same log odds
+    source_sentence_ids, attention_mask = wrapped_model.get_source_sentence_ids_batch(masked_X)
+    external_logodds = wrapped_model.get_teacher_forced_logits(source_sentence_ids, wrapped_model.target_sentence_ids.clone(), attention_mask)
+
+    assert len(prepend_calls) == 2
+    assert np.allclose(logodds, external_logodds, atol=1e-5)